@@ -1,13 +1,21 @@
-import json
+import copy
+import heapq
+import itertools
 import random
-from typing import Dict, List, Any, Optional
-from dataclasses import dataclass, asdict
+import re
+from bisect import bisect_right
+from collections import ChainMap, defaultdict, deque
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Set, Tuple
+from dataclasses import dataclass, field
 from enum import Enum
 import time
-from abc import ABC, abstractmethod
+
+# Interaction logging is off by default; each session's interaction count is always kept
+MAPR_LOG_ENABLED = False
 
 # Product and User Models
-@dataclass
+@dataclass(slots=True)
 class Product:
     id: str
     name: str
@@ -18,8 +26,21 @@ class Product:
     description: str
     stock: int
     tags: List[str]
+    # Derived lookup attributes, computed once at construction
+    name_lc: str = field(init=False, repr=False, compare=False)
+    description_lc: str = field(init=False, repr=False, compare=False)
+    category_lc: str = field(init=False, repr=False, compare=False)
+    features_lc: List[str] = field(init=False, repr=False, compare=False)
+    tags_lc: frozenset = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.name_lc = self.name.lower()
+        self.description_lc = self.description.lower()
+        self.category_lc = self.category.lower()
+        self.features_lc = [f.lower() for f in self.features]
+        self.tags_lc = frozenset(t.lower() for t in self.tags)
 
-@dataclass
+@dataclass(slots=True)
 class UserProfile:
     id: str
     name: str
@@ -30,7 +51,7 @@ class UserProfile:
     browsing_history: List[str]
     demographics: Dict[str, Any]
 
-@dataclass
+@dataclass(slots=True)
 class Interaction:
     agent_id: str
     message: str
@@ -43,31 +64,152 @@ class AgentType(Enum):
     FINALIZER = "finalizer"
     COORDINATOR = "coordinator"
 
+@dataclass(slots=True)
+class SessionState:
+    """Mutable state of one coordinated session, so concurrent sessions never share logs"""
+    session_id: str
+    browser_log: List[Dict[str, Any]] = field(default_factory=list)
+    questioner_log: List[Dict[str, Any]] = field(default_factory=list)
+    finalizer_log: List[Dict[str, Any]] = field(default_factory=list)
+    coordinator_log: List[Dict[str, Any]] = field(default_factory=list)
+    n_interactions: int = 0
+    
+    def log_for(self, agent_type: AgentType) -> List[Dict[str, Any]]:
+        return getattr(self, f"{agent_type.value}_log")
+
+# Process-wide id sequences; unlike timestamps they never collide within a second
+_session_counter = itertools.count(1)
+_user_counter = itertools.count(1)
+
+def _profile_snapshot(user_profile: UserProfile) -> Dict[str, Any]:
+    """Dict view of a profile; lists get one-level copies, demographics a deep copy as it may nest"""
+    return {
+        'id': user_profile.id,
+        'name': user_profile.name,
+        'age': user_profile.age,
+        'preferences': list(user_profile.preferences),
+        'purchase_history': list(user_profile.purchase_history),
+        'budget_range': user_profile.budget_range,
+        'browsing_history': list(user_profile.browsing_history),
+        'demographics': copy.deepcopy(user_profile.demographics)
+    }
+
+def _derive_features(user_profile: UserProfile) -> Dict[str, Any]:
+    """Per-user values that several agents need, computed once per session"""
+    min_budget, max_budget = user_profile.budget_range
+    preferences_lc = tuple(p.lower() for p in user_profile.preferences)
+    return {
+        'budget_mid': (min_budget + max_budget) / 2,
+        'preferences_lc': preferences_lc,
+        'preferences_set': frozenset(preferences_lc),
+        'preferences_title': tuple(p.title() for p in user_profile.preferences),
+        'usage_context': 'personal' if user_profile.age < 40 else 'home'
+    }
+
+def _topk(scores: List[float], k: int) -> List[int]:
+    """Indices of the k highest scores, best first; ties keep their original order"""
+    return heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+
 # Base Agent Class
-class BaseAgent(ABC):
-    def __init__(self, agent_id: str, agent_type: AgentType):
+class BaseAgent:
+    def __init__(self, agent_id: str, agent_type: AgentType, history_limit: int = 1024):
         self.agent_id = agent_id
         self.agent_type = agent_type
         self.knowledge_base = {}
-        self.interaction_history = []
+        # Log of interactions outside any session, kept column-wise; oldest entries drop off once full
+        self._log_timestamps = deque(maxlen=history_limit)
+        self._log_messages = deque(maxlen=history_limit)
+        self._log_data = deque(maxlen=history_limit)
     
-    @abstractmethod
     def process(self, user_profile: UserProfile, context: Dict[str, Any]) -> Dict[str, Any]:
-        pass
-    
-    def log_interaction(self, message: str, data: Dict[str, Any] = None):
-        interaction = Interaction(
-            agent_id=self.agent_id,
-            message=message,
-            timestamp=time.time(),
-            data=data or {}
-        )
-        self.interaction_history.append(interaction)
+        raise NotImplementedError
+    
+    def log_interaction(self, message: str, data: Dict[str, Any] = None, session: Optional[SessionState] = None):
+        if session is not None:
+            session.n_interactions += 1
+        if not MAPR_LOG_ENABLED:
+            return
+        if session is not None:
+            session.log_for(self.agent_type).append(
+                {'agent_id': self.agent_id, 'message': message, 'timestamp': time.time(), 'data': data or {}})
+            return
+        self._log_timestamps.append(time.time())
+        self._log_messages.append(message)
+        self._log_data.append(data or {})
+    
+    @property
+    def interaction_history(self) -> List[Interaction]:
+        """Logged interactions, oldest first, built on access"""
+        return [Interaction(self.agent_id, message, timestamp, data)
+                for timestamp, message, data in zip(self._log_timestamps, self._log_messages, self._log_data)]
 
 # Product Database
 class ProductDatabase:
     def __init__(self):
-        self.products = self._initialize_products()
+        self.products = self._initialize_products()  # Product id -> Product
+        self.product_list = list(self.products.values())  # Catalog rows, in insertion order
+        self.row_of = {p.id: row for row, p in enumerate(self.product_list)}  # Product id -> row
+        self.version = 0  # Bumped on every catalog change so derived caches can key on it
+        
+        # Products per lowercased category, cheapest first, with their prices for bisecting;
+        # maintained incrementally by add_product
+        self.by_category = defaultdict(list)
+        self.category_prices = defaultdict(list)
+        for product in self.product_list:
+            self._index_category(product)
+        
+        self._build_columns()
+    
+    def _index_category(self, product: Product):
+        prices = self.category_prices[product.category_lc]
+        pos = bisect_right(prices, product.price)
+        prices.insert(pos, product.price)
+        self.by_category[product.category_lc].insert(pos, product)
+    
+    def _unindex_category(self, product: Product):
+        bucket = self.by_category[product.category_lc]
+        pos = next(i for i, p in enumerate(bucket) if p is product)
+        del bucket[pos]
+        del self.category_prices[product.category_lc][pos]
+    
+    def _build_columns(self):
+        """Lay the catalog out column-wise so agents can score products by row index"""
+        self.prices = [p.price for p in self.product_list]
+        self.ratings = [p.rating for p in self.product_list]
+        self.stocks = [p.stock for p in self.product_list]
+        # Profile-independent part of the collaborative score
+        self.rating_prior = [(rating / 5.0) * 0.3 for rating in self.ratings]
+        
+        # Category vocabulary, with per-row ids into it
+        self.categories = []
+        self.category_ids = {}
+        self.cat_ids = []
+        for product in self.product_list:
+            if product.category not in self.category_ids:
+                self.category_ids[product.category] = len(self.categories)
+                self.categories.append(product.category)
+            self.cat_ids.append(self.category_ids[product.category])
+        
+        # Feature vocabulary (lowercased) assigning one bit per feature, and each row's feature bitmask
+        self.feature_bit = {}
+        self.feature_bits = []
+        for product in self.product_list:
+            bits = 0
+            for feature in product.features_lc:
+                bits |= self.feature_bit.setdefault(feature, 1 << len(self.feature_bit))
+            self.feature_bits.append(bits)
+        self.preference_masks = lru_cache(maxsize=1024)(self._encode_preferences)
+        
+        # Inverted indexes from tag, lowercased category and name/description word to rows
+        self._by_tag = defaultdict(set)
+        self._by_category = defaultdict(set)
+        self._by_token = defaultdict(set)
+        for row, product in enumerate(self.product_list):
+            for tag in product.tags:
+                self._by_tag[tag].add(row)
+            self._by_category[product.category_lc].add(row)
+            for token in re.findall(r'\w+', product.name_lc + ' ' + product.description_lc):
+                self._by_token[token].add(row)
     
     def _initialize_products(self) -> Dict[str, Product]:
         sample_products = [
@@ -93,74 +235,123 @@ class ProductDatabase:
         return {p.id: p for p in sample_products}
     
     def search_products(self, query: str = "", category: str = "", tags: List[str] = None) -> List[Product]:
-        results = []
-        for product in self.products.values():
-            match = True
-            if query and query.lower() not in product.name.lower() and query.lower() not in product.description.lower():
-                match = False
-            if category and category.lower() != product.category.lower():
-                match = False
-            if tags and not any(tag in product.tags for tag in tags):
-                match = False
-            if match:
-                results.append(product)
-        return results
+        """Match products containing every query word, in the category, with any of the tags"""
+        if not query and not category and not tags:
+            return list(self.product_list)
+        
+        rows = None
+        if category:
+            rows = set(self._by_category.get(category.lower(), ()))
+        if tags:
+            tag_rows = set().union(*(self._by_tag.get(tag, ()) for tag in tags))
+            rows = tag_rows if rows is None else rows & tag_rows
+        if query:
+            tokens = re.findall(r'\w+', query.lower())
+            query_rows = set.intersection(*(self._by_token.get(t, set()) for t in tokens)) if tokens else set()
+            rows = query_rows if rows is None else rows & query_rows
+        return [self.product_list[row] for row in sorted(rows)]
+    
+    def features_containing(self, term: str) -> int:
+        """Bitmask of the catalog features whose lowercased text contains term"""
+        mask = 0
+        for feature, bit in self.feature_bit.items():
+            if term in feature:
+                mask |= bit
+        return mask
+    
+    def _encode_preferences(self, preferences_lc: Tuple[str, ...]) -> Tuple[int, ...]:
+        """Per-preference feature masks, merged into one when no feature matches two preferences"""
+        masks = [self.features_containing(pref) for pref in preferences_lc]
+        union = 0
+        for mask in masks:
+            if union & mask:
+                return tuple(masks)
+            union |= mask
+        return (union,)
+    
+    def rows_tagged(self, tag: str) -> Set[int]:
+        return self._by_tag.get(tag, set())
     
     def get_product(self, product_id: str) -> Optional[Product]:
         return self.products.get(product_id)
+    
+    def add_product(self, product: Product):
+        row = self.row_of.get(product.id)
+        if row is None:
+            self.row_of[product.id] = len(self.product_list)
+            self.product_list.append(product)
+        else:
+            self._unindex_category(self.product_list[row])
+            self.product_list[row] = product
+        self.products[product.id] = product
+        self._index_category(product)
+        self.version += 1
+        self._build_columns()
 
 # Browsing Agent
 class BrowsingAgent(BaseAgent):
-    def __init__(self, product_db: ProductDatabase):
+    def __init__(self, product_db: ProductDatabase, seed: Optional[int] = None):
         super().__init__("browser_001", AgentType.BROWSER)
         self.product_db = product_db
+        self._rng = random.Random(seed)  # Seed for reproducible confidence scores
         self.recommendation_algorithms = {
             'collaborative': self._collaborative_filtering,
             'content_based': self._content_based_filtering,
             'hybrid': self._hybrid_filtering
         }
+        self._cached_interests = lru_cache(maxsize=1024)(self._compute_interests)
     
     def process(self, user_profile: UserProfile, context: Dict[str, Any]) -> Dict[str, Any]:
-        self.log_interaction("Starting product browsing and recommendation", {"user_id": user_profile.id})
+        session = context.get('session')
+        self.log_interaction("Starting product browsing and recommendation", {"user_id": user_profile.id}, session)
         
         # Analyze user preferences and history
         user_interests = self._analyze_user_interests(user_profile)
+        derived = context.get('derived') or _derive_features(user_profile)
         
-        # Get initial recommendations using hybrid approach
-        recommendations = self._hybrid_filtering(user_profile, user_interests)
-        
-        # Filter by budget
-        budget_filtered = self._filter_by_budget(recommendations, user_profile.budget_range)
+        # Get initial recommendations within budget using hybrid approach
+        recommendations = self._hybrid_filtering(user_profile, user_interests, derived['preferences_lc'])
         
         # Rank recommendations
-        ranked_recommendations = self._rank_recommendations(budget_filtered, user_profile)
+        ranked_recommendations = self._rank_recommendations(recommendations, user_profile)
+        uniform = self._rng.uniform
         
         result = {
-            'recommended_products': ranked_recommendations[:5],  # Top 5
+            'recommended_products': ranked_recommendations,  # Top 5
             'user_interests': user_interests,
-            'reasoning': self._generate_reasoning(ranked_recommendations, user_profile),
-            'confidence_scores': {p.id: random.uniform(0.7, 0.95) for p in ranked_recommendations[:5]}
+            'reasoning': self._generate_reasoning(ranked_recommendations, derived['preferences_set']),
+            'confidence_scores': {p.id: uniform(0.7, 0.95) for p in ranked_recommendations},
+            '_counts': {'recommended': len(ranked_recommendations)}
         }
         
         self.log_interaction("Generated initial recommendations", 
-                           {"count": len(ranked_recommendations), "top_categories": list(user_interests.keys())})
+                           {"count": len(recommendations), "top_categories": list(user_interests.keys())}, session)
         
         return result
     
     def _analyze_user_interests(self, user_profile: UserProfile) -> Dict[str, float]:
+        # Only these profile fields feed the analysis; copy so callers can't mutate the cache
+        interests = self._cached_interests(tuple(user_profile.preferences),
+                                           tuple(user_profile.browsing_history),
+                                           tuple(user_profile.purchase_history),
+                                           self.product_db.version)
+        return dict(interests)
+    
+    def _compute_interests(self, preferences: tuple, browsing_history: tuple,
+                           purchase_history: tuple, catalog_version: int) -> Dict[str, float]:
         interests = {}
         
         # Analyze preferences
-        for pref in user_profile.preferences:
+        for pref in preferences:
             interests[pref] = interests.get(pref, 0) + 0.3
         
         # Analyze browsing history
-        for item in user_profile.browsing_history:
+        for item in browsing_history:
             category = item.split('_')[0] if '_' in item else item
             interests[category] = interests.get(category, 0) + 0.2
         
         # Analyze purchase history
-        for purchase in user_profile.purchase_history:
+        for purchase in purchase_history:
             product = self.product_db.get_product(purchase)
             if product:
                 interests[product.category] = interests.get(product.category, 0) + 0.5
@@ -169,77 +360,81 @@ class BrowsingAgent(BaseAgent):
         
         return interests
     
-    def _collaborative_filtering(self, user_profile: UserProfile, interests: Dict[str, float]) -> List[Product]:
+    def _collaborative_filtering(self, user_profile: UserProfile, interests: Dict[str, float],
+                                preferences_lc: Tuple[str, ...]) -> List[Product]:
         # Simulated collaborative filtering
-        all_products = list(self.product_db.products.values())
-        scored_products = []
-        
-        for product in all_products:
-            score = 0
-            # Boost score based on category interest
-            if product.category.lower() in [k.lower() for k in interests.keys()]:
-                score += interests.get(product.category, 0) * 0.4
-            
-            # Boost score based on tag matching
-            for tag in product.tags:
-                if tag.lower() in [k.lower() for k in interests.keys()]:
-                    score += interests.get(tag, 0) * 0.2
-            
-            # Add rating influence
-            score += (product.rating / 5.0) * 0.3
-            
-            scored_products.append((product, score))
-        
-        return [p[0] for p in sorted(scored_products, key=lambda x: x[1], reverse=True)]
+        collab_scores, _ = self._score_products(user_profile, interests, preferences_lc)
+        return self._rank_by_scores(collab_scores, 10)
     
-    def _content_based_filtering(self, user_profile: UserProfile, interests: Dict[str, float]) -> List[Product]:
+    def _content_based_filtering(self, user_profile: UserProfile, interests: Dict[str, float],
+                                 preferences_lc: Tuple[str, ...]) -> List[Product]:
         # Content-based filtering using product features
-        all_products = list(self.product_db.products.values())
-        scored_products = []
-        
-        for product in all_products:
-            score = 0
-            
-            # Feature matching with user preferences
-            for feature in product.features:
-                for pref in user_profile.preferences:
-                    if pref.lower() in feature.lower():
-                        score += 0.4
-            
-            # Category matching
-            category_score = interests.get(product.category, 0)
-            score += category_score * 0.3
+        _, content_scores = self._score_products(user_profile, interests, preferences_lc)
+        return self._rank_by_scores(content_scores, 10)
+    
+    def _score_products(self, user_profile: UserProfile, interests: Dict[str, float],
+                        preferences_lc: Tuple[str, ...]) -> Tuple[List[float], List[float]]:
+        """Collaborative and content-based scores for every product, in a single pass over the catalog"""
+        db = self.product_db
+        # Preferences encoded as feature masks, so matching a product is bitwise
+        pref_masks = db.preference_masks(preferences_lc)
+        cat_interest = [interests.get(c, 0) for c in db.categories]
+        
+        # Tag matches are accumulated term-at-a-time from the tag postings,
+        # so only products sharing a tag with the user's interests are visited
+        tag_boost = [0] * len(db.product_list)
+        for term, weight in interests.items():
+            for row in db.rows_tagged(term):
+                tag_boost[row] += weight * 0.2
+        
+        collab_scores = []
+        content_scores = []
+        
+        for cat_id, boost, feature_bits, prior in zip(db.cat_ids, tag_boost, db.feature_bits, db.rating_prior):
+            # Collaborative: category interest, tag matches and rating influence
+            collab_scores.append(cat_interest[cat_id] * 0.4 + boost + prior)
             
-            scored_products.append((product, score))
+            # Content-based: feature matches with preferences, then category interest
+            matches = 0
+            for mask in pref_masks:
+                matches += (feature_bits & mask).bit_count()
+            content_scores.append(matches * 0.4 + cat_interest[cat_id] * 0.3)
         
-        return [p[0] for p in sorted(scored_products, key=lambda x: x[1], reverse=True)]
+        return collab_scores, content_scores
     
-    def _hybrid_filtering(self, user_profile: UserProfile, interests: Dict[str, float]) -> List[Product]:
-        collab_results = self._collaborative_filtering(user_profile, interests)
-        content_results = self._content_based_filtering(user_profile, interests)
-        
-        # Combine results with weighted scoring
-        product_scores = {}
-        
-        for i, product in enumerate(collab_results[:10]):
-            score = (10 - i) / 10 * 0.6  # Collaborative weight
-            product_scores[product.id] = product_scores.get(product.id, 0) + score
-        
-        for i, product in enumerate(content_results[:10]):
-            score = (10 - i) / 10 * 0.4  # Content-based weight
-            product_scores[product.id] = product_scores.get(product.id, 0) + score
+    def _rank_by_scores(self, scores: List[float], k: int) -> List[Product]:
+        products = self.product_db.product_list
+        return [products[i] for i in _topk(scores, k)]
+    
+    def _hybrid_filtering(self, user_profile: UserProfile, interests: Dict[str, float],
+                          preferences_lc: Tuple[str, ...]) -> List[Product]:
+        collab_scores, content_scores = self._score_products(user_profile, interests, preferences_lc)
+        prices = self.product_db.prices
+        min_budget, max_budget = user_profile.budget_range
+        
+        # Combine results with weighted scoring, skipping products outside the budget
+        products = self.product_db.product_list
+        row_scores = [0] * len(products)
+        pool = []  # Candidate rows in first-seen order, which breaks score ties
+        
+        for i, row in enumerate(_topk(collab_scores, 10)):
+            if min_budget <= prices[row] <= max_budget:
+                pool.append(row)
+                row_scores[row] = (10 - i) / 10 * 0.6  # Collaborative weight
+        
+        for i, row in enumerate(_topk(content_scores, 10)):
+            if min_budget <= prices[row] <= max_budget:
+                if row_scores[row] == 0:
+                    pool.append(row)
+                row_scores[row] += (10 - i) / 10 * 0.4  # Content-based weight
         
         # Sort by combined scores
-        sorted_products = sorted(product_scores.items(), key=lambda x: x[1], reverse=True)
-        return [self.product_db.get_product(pid) for pid, _ in sorted_products]
-    
-    def _filter_by_budget(self, products: List[Product], budget_range: tuple) -> List[Product]:
-        min_budget, max_budget = budget_range
-        return [p for p in products if min_budget <= p.price <= max_budget]
+        pool.sort(key=row_scores.__getitem__, reverse=True)
+        return [products[row] for row in pool]
     
     def _rank_recommendations(self, products: List[Product], user_profile: UserProfile) -> List[Product]:
         # Additional ranking based on user-specific factors
-        scored_products = []
+        scores = []
         
         for product in products:
             score = 0
@@ -257,19 +452,20 @@ class BrowsingAgent(BaseAgent):
             if product.stock > 10:
                 score += 0.1
             
-            scored_products.append((product, score))
+            scores.append(score)
         
-        return [p[0] for p in sorted(scored_products, key=lambda x: x[1], reverse=True)]
+        return [products[i] for i in _topk(scores, 5)]
     
-    def _generate_reasoning(self, products: List[Product], user_profile: UserProfile) -> List[str]:
+    def _generate_reasoning(self, products: List[Product], preferences: frozenset) -> List[str]:
+        # preferences holds the user's lowercased preferences
         reasoning = []
         for product in products[:3]:  # Top 3 reasonings
             reasons = []
-            if product.category.lower() in [p.lower() for p in user_profile.preferences]:
+            if product.category_lc in preferences:
                 reasons.append(f"matches your interest in {product.category}")
             if product.rating >= 4.5:
                 reasons.append("highly rated by customers")
-            if any(tag in user_profile.preferences for tag in product.tags):
+            if not product.tags_lc.isdisjoint(preferences):
                 reasons.append("aligns with your preferences")
             
             reasoning.append(f"{product.name}: " + ", ".join(reasons))
@@ -277,6 +473,8 @@ class BrowsingAgent(BaseAgent):
 
 # Questioning Agent
 class QuestioningAgent(BaseAgent):
+    PRIORITY_RANK = {'high': 0, 'medium': 1, 'low': 2}
+    
     def __init__(self):
         super().__init__("questioner_001", AgentType.QUESTIONER)
         self.question_templates = {
@@ -304,9 +502,10 @@ class QuestioningAgent(BaseAgent):
     
     def process(self, user_profile: UserProfile, context: Dict[str, Any]) -> Dict[str, Any]:
         recommended_products = context.get('recommended_products', [])
+        session = context.get('session')
         
         self.log_interaction("Analyzing recommendations for clarification needs", 
-                           {"product_count": len(recommended_products)})
+                           {"product_count": len(recommended_products)}, session)
         
         # Generate targeted questions based on recommendations
         questions = self._generate_targeted_questions(user_profile, recommended_products)
@@ -325,7 +524,7 @@ class QuestioningAgent(BaseAgent):
             'interaction_strategy': self._determine_interaction_strategy(user_profile)
         }
         
-        self.log_interaction("Generated clarification questions", {"question_count": len(questions)})
+        self.log_interaction("Generated clarification questions", {"question_count": len(questions)}, session)
         
         return result
     
@@ -433,21 +632,10 @@ class QuestioningAgent(BaseAgent):
         return follow_ups
     
     def _prioritize_questions(self, questions: List[Dict[str, Any]]) -> List[str]:
-        priority_order = []
-        
-        # High priority first
-        high_priority = [q['question'] for q in questions if q.get('priority') == 'high']
-        priority_order.extend(high_priority)
-        
-        # Medium priority next
-        medium_priority = [q['question'] for q in questions if q.get('priority') == 'medium']
-        priority_order.extend(medium_priority)
-        
-        # Low priority last
-        low_priority = [q['question'] for q in questions if q.get('priority') == 'low']
-        priority_order.extend(low_priority)
-        
-        return priority_order
+        # High priority first, then medium, then low; questions keep their order within a level
+        ranked = [q for q in questions if q.get('priority') in self.PRIORITY_RANK]
+        ranked.sort(key=lambda q: self.PRIORITY_RANK[q['priority']])
+        return [q['question'] for q in ranked]
     
     def _determine_interaction_strategy(self, user_profile: UserProfile) -> Dict[str, Any]:
         strategy = {
@@ -476,20 +664,22 @@ class FinalizerAgent(BaseAgent):
         self.cross_sell_rules = self._initialize_cross_sell_rules()
     
     def _initialize_cross_sell_rules(self) -> Dict[str, List[str]]:
+        # Tag -> ids of complementary products
         return {
-            'gaming': ['Gaming Mouse RGB', 'Wireless Headphones Elite'],
-            'laptop': ['Gaming Mouse RGB', 'Wireless Headphones Elite'],
-            'fitness': ['Bluetooth Speaker'],
-            'kitchen': ['Smart Fitness Watch'],  # Health-conscious cross-sell
-            'audio': ['Gaming Laptop Pro']  # Entertainment ecosystem
+            'gaming': ['5', '2'],  # Gaming Mouse RGB, Wireless Headphones Elite
+            'laptop': ['5', '2'],  # Gaming Mouse RGB, Wireless Headphones Elite
+            'fitness': ['6'],  # Bluetooth Speaker
+            'kitchen': ['3'],  # Smart Fitness Watch - health-conscious cross-sell
+            'audio': ['1']  # Gaming Laptop Pro - entertainment ecosystem
         }
     
     def process(self, user_profile: UserProfile, context: Dict[str, Any]) -> Dict[str, Any]:
         recommended_products = context.get('recommended_products', [])
         user_responses = context.get('user_responses', {})
+        session = context.get('session')
         
         self.log_interaction("Starting finalization process", 
-                           {"products": len(recommended_products), "responses": len(user_responses)})
+                           {"products": len(recommended_products), "responses": len(user_responses)}, session)
         
         # Refine recommendations based on user responses
         refined_products = self._refine_recommendations(recommended_products, user_responses, user_profile)
@@ -517,16 +707,19 @@ class FinalizerAgent(BaseAgent):
             'pricing_information': pricing_info,
             'cart_preview': self._generate_cart_preview(refined_products),
             'next_steps': self._generate_next_steps(),
-            'personalized_message': self._generate_personalized_message(user_profile, refined_products)
+            'personalized_message': self._generate_personalized_message(user_profile, refined_products),
+            '_counts': {'recommended': len(refined_products), 'cross_sell': len(cross_sell_items),
+                        'bundles': len(bundles)}
         }
         
-        self.log_interaction("Finalization complete", {"final_count": len(refined_products)})
+        self.log_interaction("Finalization complete", {"final_count": result['_counts']['recommended']}, session)
         
         return result
     
     def _refine_recommendations(self, products: List[Product], responses: Dict[str, Any], 
                               user_profile: UserProfile) -> List[Product]:
         refined = []
+        scores = []
         
         for product in products:
             score = 1.0  # Base score
@@ -545,28 +738,31 @@ class FinalizerAgent(BaseAgent):
                     continue  # Skip if over budget
             
             if 'required_features' in responses:
-                feature_match = any(req in ' '.join(product.features).lower() 
-                                  for req in responses['required_features'])
+                features_text = ' '.join(product.features).lower()
+                feature_match = any(req in features_text for req in responses['required_features'])
                 if feature_match:
                     score *= 1.3
             
-            refined.append((product, score))
+            refined.append(product)
+            scores.append(score)
         
-        # Sort by refined score and return top products
-        refined.sort(key=lambda x: x[1], reverse=True)
-        return [p[0] for p in refined[:3]]  # Top 3 refined recommendations
+        # Top 3 refined recommendations by score
+        return [refined[i] for i in _topk(scores, 3)]
     
     def _generate_cross_sell(self, main_products: List[Product], user_profile: UserProfile) -> List[Product]:
         cross_sell = []
+        seen_ids = {p.id for p in main_products}
         
         for product in main_products:
             # Find complementary products based on tags and category
             for tag in product.tags:
-                if tag in self.cross_sell_rules:
-                    for cross_sell_name in self.cross_sell_rules[tag]:
-                        cross_sell_product = self._find_product_by_name(cross_sell_name)
-                        if cross_sell_product and cross_sell_product not in main_products:
-                            cross_sell.append(cross_sell_product)
+                for cross_sell_id in self.cross_sell_rules.get(tag, ()):
+                    if cross_sell_id in seen_ids:
+                        continue
+                    cross_sell_product = self.product_db.get_product(cross_sell_id)
+                    if cross_sell_product:
+                        seen_ids.add(cross_sell_id)
+                        cross_sell.append(cross_sell_product)
         
         # Filter by budget
         budget_max = user_profile.budget_range[1]
@@ -580,20 +776,24 @@ class FinalizerAgent(BaseAgent):
     def _generate_upsell(self, products: List[Product], user_profile: UserProfile) -> List[Product]:
         upsells = []
         budget_max = user_profile.budget_range[1]
+        db = self.product_db
         
         for product in products:
-            # Find higher-end alternatives in the same category
-            category_products = self.product_db.search_products(category=product.category)
-            higher_end = [p for p in category_products 
-                         if p.price > product.price and p.price <= budget_max 
-                         and p.rating >= product.rating]
+            # Walk pricier products in the same category, cheapest first, and
+            # pick the first affordable one rated at least as well
+            category_products = db.by_category.get(product.category_lc, [])
+            start = bisect_right(db.category_prices.get(product.category_lc, []), product.price)
+            for candidate in itertools.islice(category_products, start, None):
+                if candidate.price > budget_max:
+                    break
+                if candidate.rating >= product.rating:
+                    upsells.append(candidate)
+                    break
             
-            if higher_end:
-                # Sort by price and pick the best value upsell
-                higher_end.sort(key=lambda x: x.price)
-                upsells.append(higher_end[0])
+            if len(upsells) == 2:  # Limit to 2 upsell suggestions
+                break
         
-        return upsells[:2]  # Limit to 2 upsell suggestions
+        return upsells
     
     def _create_bundles(self, main_products: List[Product], cross_sell_items: List[Product]) -> List[Dict[str, Any]]:
         bundles = []
@@ -652,12 +852,15 @@ class FinalizerAgent(BaseAgent):
         return pricing
     
     def _generate_cart_preview(self, products: List[Product]) -> Dict[str, Any]:
+        subtotal = sum(p.price for p in products)
+        tax = subtotal * 0.08  # 8% tax estimate
+        shipping = 9.99 if subtotal < 50 else 0.0
         return {
             'items': [{'name': p.name, 'price': p.price, 'quantity': 1} for p in products],
-            'subtotal': sum(p.price for p in products),
-            'estimated_tax': sum(p.price for p in products) * 0.08,  # 8% tax estimate
-            'estimated_shipping': 9.99 if sum(p.price for p in products) < 50 else 0.0,
-            'estimated_total': sum(p.price for p in products) * 1.08 + (9.99 if sum(p.price for p in products) < 50 else 0.0)
+            'subtotal': subtotal,
+            'estimated_tax': tax,
+            'estimated_shipping': shipping,
+            'estimated_total': subtotal + tax + shipping
         }
     
     def _generate_next_steps(self) -> List[str]:
@@ -687,22 +890,44 @@ class FinalizerAgent(BaseAgent):
         
         return message
     
-    def _find_product_by_name(self, name: str) -> Optional[Product]:
-        for product in self.product_db.products.values():
-            if product.name == name:
-                return product
-        return None
-    
     def _create_final_recommendation(self, products: List[Product], cross_sell: List[Product], 
                                    bundles: List[Dict[str, Any]], pricing: Dict[str, Any]) -> Dict[str, Any]:
+        n = len(products)
+        plural = 'es' if n != 1 else ''
         return {
-            'summary': f"Found {len(products)} perfect match{'es' if len(products) != 1 else ''} for you",
+            'summary': f"Found {n} perfect match{plural} for you",
             'confidence': 0.92,  # High confidence in final recommendations
             'total_value': pricing['individual_total'],
             'potential_savings': pricing['best_bundle_savings'],
-            'recommendation_strength': 'High' if len(products) >= 2 else 'Medium'
+            'recommendation_strength': 'High' if n >= 2 else 'Medium'
         }
 
+# Simulated answers to clarification questions, by question type
+def _respond_budget(user_profile: UserProfile, derived: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+    # Narrow down budget based on user profile
+    max_budget = user_profile.budget_range[1]
+    mid_point = derived['budget_mid']
+    return 'max_price', mid_point + (max_budget - mid_point) * 0.3
+
+def _respond_feature_preferences(user_profile: UserProfile, derived: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+    # Select preferred category based on user preferences
+    if derived['preferences_title']:
+        return 'preferred_category', derived['preferences_title'][0]
+    return None
+
+def _respond_usage_context(user_profile: UserProfile, derived: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+    return 'usage_context', derived['usage_context']
+
+def _respond_experience_level(user_profile: UserProfile, derived: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+    return 'experience_level', 'intermediate'
+
+_RESPONSE_HANDLERS = {
+    'budget_clarification': _respond_budget,
+    'feature_preferences': _respond_feature_preferences,
+    'usage_context': _respond_usage_context,
+    'experience_level': _respond_experience_level
+}
+
 # Coordinator Agent
 class CoordinatorAgent(BaseAgent):
     def __init__(self, product_db: ProductDatabase):
@@ -714,67 +939,66 @@ class CoordinatorAgent(BaseAgent):
         self.session_state = {}
     
     def process(self, user_profile: UserProfile, context: Dict[str, Any]) -> Dict[str, Any]:
-        self.log_interaction("Starting MAPR coordination", {"user_id": user_profile.id})
+        # Each session gets its own state, so concurrent sessions never share logs
+        session = SessionState(f"mapr_session_{next(_session_counter):x}")
+        return self._run_session(user_profile, context, session)
+    
+    def _run_session(self, user_profile: UserProfile, context: Dict[str, Any],
+                     session: SessionState) -> Dict[str, Any]:
+        self.log_interaction("Starting MAPR coordination", {"user_id": user_profile.id}, session)
+        
+        # Per-user features shared by the phases below
+        derived = _derive_features(user_profile)
         
         # Phase 1: Browsing and Initial Recommendations
-        browse_result = self.browser.process(user_profile, context)
+        browse_result = self.browser.process(user_profile, {**context, 'derived': derived, 'session': session})
         
         # Phase 2: Generate Clarifying Questions
-        question_result = self.questioner.process(user_profile, browse_result)
+        question_result = self.questioner.process(user_profile, ChainMap({'session': session}, browse_result))
         
         # Phase 3: Simulate user responses (in real implementation, this would be actual user input)
-        simulated_responses = self._simulate_user_responses(question_result, user_profile)
+        simulated_responses = self._simulate_user_responses(question_result, user_profile, derived)
         
         # Phase 4: Final recommendations and cart preparation
-        final_context = {
-            **browse_result,
+        # Overlay the new keys on the browse result rather than copying it
+        final_context = ChainMap({
             'user_responses': simulated_responses,
-            'questions_asked': question_result
-        }
+            'questions_asked': question_result,
+            'session': session
+        }, browse_result)
         final_result = self.finalizer.process(user_profile, final_context)
         
         # Compile comprehensive result
         comprehensive_result = {
-            'session_id': f"mapr_session_{int(time.time())}",
-            'user_profile': asdict(user_profile),
+            'session_id': session.session_id,
+            'user_profile': _profile_snapshot(user_profile),
             'phase_1_browsing': browse_result,
             'phase_2_questioning': question_result,
             'phase_3_responses': simulated_responses,
             'phase_4_finalization': final_result,
-            'agent_interactions': self._compile_agent_interactions(),
+            'agent_interactions': self._compile_agent_interactions(session),
             'session_summary': self._generate_session_summary(browse_result, final_result),
-            'performance_metrics': self._calculate_performance_metrics()
+            'performance_metrics': self._calculate_performance_metrics(session)
         }
         
         self.log_interaction("MAPR coordination complete", 
-                           {"phases_completed": 4, "final_recommendations": len(final_result.get('final_recommendations', []))})
+                           {"phases_completed": 4, "final_recommendations": final_result['_counts']['recommended']},
+                           session)
         
         return comprehensive_result
     
-    def _simulate_user_responses(self, question_result: Dict[str, Any], user_profile: UserProfile) -> Dict[str, Any]:
+    def _simulate_user_responses(self, question_result: Dict[str, Any], user_profile: UserProfile,
+                                 derived: Dict[str, Any]) -> Dict[str, Any]:
         """Simulate user responses to questions - in real implementation, this would be user input"""
         questions = question_result.get('clarification_questions', [])
         responses = {}
         
         for question in questions[:2]:  # Respond to first 2 questions
-            q_type = question.get('type', '')
-            
-            if q_type == 'budget_clarification':
-                # Narrow down budget based on user profile
-                min_budget, max_budget = user_profile.budget_range
-                mid_point = (min_budget + max_budget) / 2
-                responses['max_price'] = mid_point + (max_budget - mid_point) * 0.3
-                
-            elif q_type == 'feature_preferences':
-                # Select preferred category based on user preferences
-                if user_profile.preferences:
-                    responses['preferred_category'] = user_profile.preferences[0].title()
-                    
-            elif q_type == 'usage_context':
-                responses['usage_context'] = 'personal' if user_profile.age < 40 else 'home'
-                
-            elif q_type == 'experience_level':
-                responses['experience_level'] = 'intermediate'
+            handler = _RESPONSE_HANDLERS.get(question.get('type', ''))
+            response = handler(user_profile, derived) if handler else None
+            if response:
+                key, value = response
+                responses[key] = value
         
         # Add some additional preferences
         responses['required_features'] = ['high quality', 'reliable']
@@ -782,36 +1006,35 @@ class CoordinatorAgent(BaseAgent):
         
         return responses
     
-    def _compile_agent_interactions(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Compile all agent interaction logs"""
+    def _compile_agent_interactions(self, session: SessionState) -> Dict[str, List[Dict[str, Any]]]:
+        """Compile the agent interaction logs of the current session"""
         return {
-            'browser': [asdict(interaction) for interaction in self.browser.interaction_history],
-            'questioner': [asdict(interaction) for interaction in self.questioner.interaction_history],
-            'finalizer': [asdict(interaction) for interaction in self.finalizer.interaction_history],
-            'coordinator': [asdict(interaction) for interaction in self.interaction_history]
+            'browser': session.browser_log,
+            'questioner': session.questioner_log,
+            'finalizer': session.finalizer_log,
+            'coordinator': session.coordinator_log
         }
     
     def _generate_session_summary(self, browse_result: Dict[str, Any], final_result: Dict[str, Any]) -> Dict[str, Any]:
         """Generate a summary of the entire MAPR session"""
-        initial_products = len(browse_result.get('recommended_products', []))
-        final_products = len(final_result.get('final_recommendations', []))
+        # Counts as reported by the phases themselves
+        initial_products = browse_result['_counts']['recommended']
+        final_counts = final_result['_counts']
+        final_products = final_counts['recommended']
         
         return {
             'products_initially_found': initial_products,
             'products_finally_recommended': final_products,
             'refinement_effectiveness': final_products / max(initial_products, 1),
-            'cross_sell_opportunities': len(final_result.get('cross_sell_suggestions', [])),
-            'bundle_offers_created': len(final_result.get('bundle_offers', [])),
+            'cross_sell_opportunities': final_counts['cross_sell'],
+            'bundle_offers_created': final_counts['bundles'],
             'total_potential_value': final_result.get('pricing_information', {}).get('individual_total', 0),
             'personalization_level': 'high' if final_products > 0 else 'medium'
         }
     
-    def _calculate_performance_metrics(self) -> Dict[str, Any]:
-        """Calculate performance metrics for the MAPR system"""
-        total_interactions = (len(self.browser.interaction_history) + 
-                            len(self.questioner.interaction_history) + 
-                            len(self.finalizer.interaction_history) + 
-                            len(self.interaction_history))
+    def _calculate_performance_metrics(self, session: SessionState) -> Dict[str, Any]:
+        """Calculate performance metrics for the current MAPR session"""
+        total_interactions = session.n_interactions
         
         return {
             'total_agent_interactions': total_interactions,
@@ -823,6 +1046,19 @@ class CoordinatorAgent(BaseAgent):
 
 # Main MAPR System Class
 class MAPRSystem:
+    # Display templates, one formatted block per item
+    PRODUCT_TEMPLATE = ("\n{i}. {name}\n"
+                        "   💵 Price: ${price:.2f}\n"
+                        "   ⭐ Rating: {rating}/5.0\n"
+                        "   📋 Category: {category}\n"
+                        "   ✨ Features: {features}\n"
+                        "   📝 Description: {description}")
+    CROSS_SELL_TEMPLATE = "• {name} - ${price:.2f}"
+    BUNDLE_TEMPLATE = ("• {name}\n"
+                       "  Original: ${original_price:.2f}\n"
+                       "  Bundle Price: ${bundle_price:.2f}\n"
+                       "  💰 You Save: ${savings:.2f}")
+    
     def __init__(self):
         self.product_db = ProductDatabase()
         self.coordinator = CoordinatorAgent(self.product_db)
@@ -833,7 +1069,7 @@ class MAPRSystem:
                           browsing_history: List[str] = None, demographics: Dict[str, Any] = None) -> UserProfile:
         """Create a user profile for the recommendation system"""
         return UserProfile(
-            id=f"user_{int(time.time())}",
+            id=f"user_{next(_user_counter):x}",
             name=name,
             age=age,
             preferences=preferences or [],
@@ -874,32 +1110,30 @@ class MAPRSystem:
         output.append(f"\n🎯 FINAL RECOMMENDATIONS ({len(recommendations)} products):")
         output.append("-" * 50)
         
+        product_template = self.PRODUCT_TEMPLATE
         for i, product in enumerate(recommendations, 1):
-            output.append(f"\n{i}. {product.name}")
-            output.append(f"   💵 Price: ${product.price:.2f}")
-            output.append(f"   ⭐ Rating: {product.rating}/5.0")
-            output.append(f"   📋 Category: {product.category}")
-            output.append(f"   ✨ Features: {', '.join(product.features)}")
-            output.append(f"   📝 Description: {product.description}")
+            output.append(product_template.format(
+                i=i, name=product.name, price=product.price, rating=product.rating,
+                category=product.category, features=', '.join(product.features),
+                description=product.description))
         
         # Cross-sell suggestions
         cross_sell = final_result.get('cross_sell_suggestions', [])
         if cross_sell:
             output.append(f"\n🎁 YOU MIGHT ALSO LIKE ({len(cross_sell)} items):")
             output.append("-" * 50)
+            cross_sell_template = self.CROSS_SELL_TEMPLATE
             for product in cross_sell:
-                output.append(f"• {product.name} - ${product.price:.2f}")
+                output.append(cross_sell_template.format(name=product.name, price=product.price))
         
         # Bundle offers
         bundles = final_result.get('bundle_offers', [])
         if bundles:
             output.append(f"\n📦 SPECIAL BUNDLE OFFERS ({len(bundles)} bundles):")
             output.append("-" * 50)
+            bundle_template = self.BUNDLE_TEMPLATE
             for bundle in bundles:
-                output.append(f"• {bundle['name']}")
-                output.append(f"  Original: ${bundle['original_price']:.2f}")
-                output.append(f"  Bundle Price: ${bundle['bundle_price']:.2f}")
-                output.append(f"  💰 You Save: ${bundle['savings']:.2f}")
+                output.append(bundle_template.format_map(bundle))
         
         # Cart preview
         cart = final_result.get('cart_preview', {})
@@ -930,15 +1164,15 @@ class MAPRSystem:
     
     def add_product(self, product: Product):
         """Add a new product to the database"""
-        self.product_db.products[product.id] = product
+        self.product_db.add_product(product)
     
     def get_session_history(self, session_id: str) -> Optional[Dict[str, Any]]:
         """Retrieve session history"""
         return self.active_sessions.get(session_id)
 
 # Example Usage and Demo
-def run_mapr_demo():
-    """Demonstrate the MAPR system with sample users"""
+def run_mapr_demo(interactive: bool = False):
+    """Demonstrate the MAPR system with sample users; interactive pauses between users"""
     
     print("🚀 Initializing Multi-Agent Product Recommender System...")
     mapr = MAPRSystem()
@@ -995,7 +1229,8 @@ def run_mapr_demo():
         print(f"\n{'='*80}")
         
         # Brief pause for readability
-        time.sleep(1)
+        if interactive:
+            time.sleep(1)
 
 if __name__ == "__main__":
     # Run the demonstration